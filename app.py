@@ -2,14 +2,326 @@
 
 # 1. IMPORTS
 import streamlit as st
-import os
-import google.generativeai as genai # 公式推奨のインポート
 import io 
+import hashlib # アップロード資料のハッシュ計算用
+import itertools
+import uuid
+import re
+import threading
 from pathlib import Path # ファイルパス操作用
 
-# LangChain and PDF processing imports (PDF処理にのみ使用)
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import CharacterTextSplitter
+MODEL_NAME = 'models/gemini-2.5-flash'
+CACHE_TTL = "3600s" # コンテキストキャッシュの保持時間
+CACHE_MIN_TOKENS = 1024 # gemini-2.5-flash でコンテキストキャッシュを作れる最小トークン数
+GENERATED_RESULTS_LIMIT = 64 # セッション内で保持する生成結果の件数
+INLINE_DATA_LIMIT = 18 * 1024 * 1024 # これ未満の画像・音声は File API を使わずリクエストに直接埋め込む（上限20MB）
+PDF_TOKEN_BUDGET = 500_000 # PDFから抽出するテキスト量の上限（トークン数は estimate_tokens で概算）
+CHUNK_TOKENS = 512 # 1チャンクあたりの本文の上限
+CHUNK_OVERLAP_TOKENS = 64 # 長い節を分割する際に次のチャンクへ持ち越す量
+DOC_PREFIX_TOKENS = 128 # 資料全体の文脈として先頭ページから取り出す量
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*)$")
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+DIFFICULTY_OPTIONS = ("標準", "難しい (応用・論述)", "易しい (基本・用語)")
+FORMAT_OPTIONS = ("論述形式", "一問一答形式", "選択式（4択）")
+SERVICE_TIERS = {
+    "標準": "standard",
+    "Flex (50%オフ/遅延許容)": "flex",
+    "Priority (最速)": "priority",
+}
+TIER_FALLBACK_ERROR_CODES = (429, 503) # Flex/Priority で混雑・プリエンプトされた場合のエラー（標準ティアでやり直す）
+
+IMAGE_INSTRUCTION = "以下の画像は講義の板書または重要な図です。この画像の内容を完全に理解し、それに基づいた問題を生成してください。"
+AUDIO_INSTRUCTION = "以下の音声ファイルは講義の録音です。まず内容を完全に文字起こしし、その文字起こし内容だけを参照して問題を生成してください。"
+
+PROMPT_TEMPLATE = (
+    "あなたは**{topic}**の専門家です。\n"
+    "【生成ルール】: 難易度: {difficulty} / 形式: {format_type} / 焦点: {focus}\n"
+    "このルールに従い、問題と模範解答を計5問作成してください。"
+)
+
+def build_prompt_text(topic, difficulty, format_type, professor_focus):
+    """問題生成ルールを指示するプロンプトを組み立てる。"""
+    return PROMPT_TEMPLATE.format_map({
+        'topic': topic,
+        'difficulty': difficulty,
+        'format_type': format_type,
+        'focus': professor_focus,
+    })
+
+def estimate_tokens(text):
+    """トークン数を概算する（ASCII文字は約4文字で1トークン、日本語などそれ以外は1文字≒1トークン）。"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars)
+
+def token_prefix_length(text, max_tokens):
+    """text の先頭から概算トークン数を累積し、max_tokens に収まる最長の文字数を返す（日英混在でも上限を超えない）。"""
+    ascii_chars = 0
+    other_chars = 0
+    for index, char in enumerate(text):
+        if char.isascii():
+            ascii_chars += 1
+        else:
+            other_chars += 1
+        if ascii_chars // 4 + other_chars > max_tokens:
+            return index
+    return len(text)
+
+def truncate_to_tokens(text, max_tokens):
+    """概算トークン数が max_tokens に収まるよう、text の先頭を切り出す。"""
+    return text[:token_prefix_length(text, max_tokens)]
+
+def find_split_point(text, limit):
+    """limit 以内で文や行の区切りになる位置を探す（見つからなければ limit で切る）。"""
+    for separator in ("\n", "。", ". "):
+        position = text.rfind(separator, 0, limit)
+        if position >= limit // 2:
+            return position + len(separator)
+    return limit
+
+def find_overlap_start(text, split_at, overlap):
+    """split_at の手前 overlap 以内で、行や文の区切りの直後になる最も早い位置を探す（見つからなければ重複なし）。"""
+    window_start = max(split_at - overlap, 0)
+    candidates = []
+    for separator in ("\n", "。", ". "):
+        position = text.find(separator, window_start, split_at - 1)
+        if position != -1:
+            candidates.append(position + len(separator))
+    return min(candidates, default=split_at)
+
+def chunk_pdf_markdown(pages):
+    """ページ単位のMarkdownを見出し構造に沿ってチャンク化し、各チャンクの先頭に見出しパスを付ける。"""
+    heading_stack = [] # [(見出しレベル, 見出し)]
+    chunks = []
+    body = ""
+
+    def emit(text):
+        heading_path = " > ".join(title for _, title in heading_stack)
+        chunks.append(f"[{heading_path}]\n{text}" if heading_path else text)
+
+    for page in pages:
+        for line in page["text"].splitlines():
+            match = HEADING_PATTERN.match(line)
+            if match:
+                # 見出しが変わったら直前の節を確定させる（節をまたいだ重複は持たせない）
+                if body.strip():
+                    emit(body.strip())
+                body = ""
+                level = len(match.group(1))
+                while heading_stack and heading_stack[-1][0] >= level:
+                    heading_stack.pop()
+                heading_stack.append((level, match.group(2).strip("* ")))
+                continue
+
+            body += line + "\n"
+            while estimate_tokens(body) > CHUNK_TOKENS:
+                # トークン上限に収まる文字位置を先頭から、重複させる範囲を分割位置から遡って数える
+                split_at = find_split_point(body, token_prefix_length(body, CHUNK_TOKENS))
+                emit(body[:split_at].strip())
+                overlap = token_prefix_length(body[:split_at][::-1], CHUNK_OVERLAP_TOKENS)
+                body = body[find_overlap_start(body, split_at, overlap):]
+
+    if body.strip():
+        emit(body.strip())
+    return chunks
+
+def extract_pdf_markdown(pdf_stream, token_budget=PDF_TOKEN_BUDGET):
+    """PDF（メモリ上のストリーム）をMarkdownに変換し、資料冒頭＋見出し付きチャンクをトークン予算に収まる分だけ連結して返す。"""
+    # PDF processing imports (PDFを扱うときだけ読み込み、起動時のインポートを軽くする)
+    import pymupdf
+    import pymupdf4llm
+
+    with pymupdf.open(stream=pdf_stream, filetype="pdf") as pdf_document:
+        pages = pymupdf4llm.to_markdown(pdf_document, page_chunks=True)
+    if not pages:
+        return ""
+
+    # 資料全体の文脈は全チャンクに繰り返さず、冒頭に一度だけ置く
+    doc_prefix = truncate_to_tokens(pages[0]["text"].strip(), DOC_PREFIX_TOKENS)
+    kept_chunks = [f"[資料冒頭]\n{doc_prefix}"]
+    used_tokens = estimate_tokens(doc_prefix)
+    for chunk in chunk_pdf_markdown(pages):
+        chunk_tokens = estimate_tokens(chunk)
+        if used_tokens + chunk_tokens > token_budget:
+            break
+        kept_chunks.append(chunk)
+        used_tokens += chunk_tokens
+    return CHUNK_SEPARATOR.join(kept_chunks)
+
+# 拡張子 -> (資料の前に置く指示文, ローカルでテキスト化する関数, Gemini に送るMIMEタイプ)
+# 関数が None の形式は、バイナリのまま Gemini にアップロードする
+# MIMEタイプはブラウザの申告（audio/x-wav など）ではなく拡張子から決める
+FILE_HANDLERS = {
+    ".pdf": (None, extract_pdf_markdown, "application/pdf"),
+    ".jpg": (IMAGE_INSTRUCTION, None, "image/jpeg"),
+    ".jpeg": (IMAGE_INSTRUCTION, None, "image/jpeg"),
+    ".png": (IMAGE_INSTRUCTION, None, "image/png"),
+    ".mp3": (AUDIO_INSTRUCTION, None, "audio/mp3"),
+    ".wav": (AUDIO_INSTRUCTION, None, "audio/wav"),
+}
+# 画像1枚は数百トークン程度で、コンテキストキャッシュの最小トークン数に届かない
+UNCACHEABLE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+
+@st.cache_resource
+def get_client():
+    """再実行をまたいで使い回す google-genai Client を返す。"""
+    # google-genai SDK (Gemini を呼ぶときだけ読み込み、起動時のインポートを軽くする)
+    from google import genai as google_genai
+    return google_genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
+
+def safe_delete_file(client, file_name):
+    """Gemini上のファイルを削除する（バックグラウンドスレッド用。失敗してもサーバー側で48時間後に自動削除される）。"""
+    try:
+        client.files.delete(name=file_name)
+    except Exception:
+        pass # スレッドからは画面に表示できないため、失敗は無視する
+
+class GenerationError(Exception):
+    """問題生成の各段階で発生した、ユーザーに表示するエラー。"""
+
+def load_cached_content(client, file_hash):
+    """同じ資料（同じハッシュ）のコンテキストキャッシュが有効なら、その名前を返す。"""
+    cache_name = st.session_state['context_caches'].get(file_hash)
+    if not cache_name:
+        return None
+    try:
+        return client.caches.get(name=cache_name).name
+    except Exception:
+        # TTL切れなどでキャッシュが無効になっている場合は通常のアップロードからやり直す
+        st.session_state['context_caches'].pop(file_hash, None)
+        return None
+
+def prepare_material(client, file_bytes, file_extension, filename, allow_inline=True):
+    """資料をモデルに渡すパーツのリストに変換し、(parts, アップロードしたファイル or None) を返す。
+
+    file_extension は呼び出し側で取り出した小文字の拡張子、filename はアップロード時の表示名にのみ使う。
+    allow_inline=False の場合、画像・音声はサイズにかかわらず File API にアップロードする。
+    """
+    material_parts = []
+    uploaded_material = None
+    try:
+        # 1. Keep the uploaded bytes in memory (一時ファイルは作らない)
+        file_buffer = io.BytesIO(file_bytes)
+
+        # 2. Prepare content list based on file type
+        handler = FILE_HANDLERS.get(file_extension)
+        if handler is None:
+            raise GenerationError("サポートされていないファイル形式です。")
+        instruction, loader, mime_type = handler
+        if instruction:
+            material_parts.append({'text': instruction})
+
+        if loader is not None:
+            # PDF processing (PyMuPDF renders pages directly to Markdown)
+            # 抽出したテキストのみを渡し、同じ内容のPDFファイル自体はアップロードしない
+            try:
+                material_parts.append({'text': loader(file_buffer)})
+            except Exception as load_error:
+                raise GenerationError(f"{file_extension[1:].upper()}解析エラー: {load_error}") from load_error
+
+        elif allow_inline and len(file_bytes) < INLINE_DATA_LIMIT:
+            # 小さなファイルはアップロード・削除の往復を省き、インラインデータとして送る
+            material_parts.append({'inline_data': {'mime_type': mime_type, 'data': file_bytes}})
+
+        else:
+            # 3. Upload file to Gemini (画像・音声はバイナリそのものが必要)
+            uploaded_material = client.files.upload(
+                file=file_buffer,
+                config={'mime_type': mime_type, 'display_name': filename},
+            )
+            material_parts.append({'file_data': {'file_uri': uploaded_material.uri, 'mime_type': uploaded_material.mime_type}})
+
+    except GenerationError:
+        raise
+    except Exception as e:
+        raise GenerationError(f"ファイル処理またはアップロードエラー: {e}") from e
+    return material_parts, uploaded_material
+
+def create_cached_content(client, file_hash, file_extension, material_parts):
+    """資料のコンテキストキャッシュを作り、その名前を返す（キャッシュできない資料の場合は None）。
+
+    キャッシュできないと分かった資料は context_caches に None として記録し、次回以降は試さない。
+    """
+    from google.genai import errors as genai_errors
+
+    context_caches = st.session_state['context_caches']
+    if file_hash in context_caches or file_extension in UNCACHEABLE_EXTENSIONS:
+        return None
+
+    # テキストだけの資料（PDF）は手元の概算で最小トークン数に届かないと分かれば送らない
+    # 画像・音声のトークン数は手元で数えられないため、下の「too small」エラーで判定する
+    if all('text' in part for part in material_parts):
+        if sum(estimate_tokens(part['text']) for part in material_parts) < CACHE_MIN_TOKENS:
+            context_caches[file_hash] = None
+            return None
+
+    # 4. Create an explicit context cache so that regenerations only send the prompt
+    material_contents = [{'role': 'user', 'parts': material_parts}]
+    try:
+        cached_content = client.caches.create(
+            model=MODEL_NAME,
+            config={
+                'display_name': file_hash,
+                'contents': material_contents,
+                'ttl': CACHE_TTL,
+            },
+        )
+    except genai_errors.ClientError as cache_error:
+        # 最小トークン数に満たない資料はキャッシュできないため、通常の呼び出しにフォールバック（それ以外のエラーはそのまま上げる）
+        if cache_error.code != 400 or "too small" not in str(cache_error).lower():
+            raise
+        context_caches[file_hash] = None
+        return None
+    context_caches[file_hash] = cached_content.name
+    return cached_content.name
+
+def stream_problems(client, prompt_parts, cache_name, service_tier, placeholder):
+    """問題を生成し、届いた分から placeholder に表示しながら (全文, 実際に使った処理優先度) を返す。"""
+    from google.genai import errors as genai_errors
+
+    # Flex/Priority が混雑で断られた・途中でプリエンプトされた場合は、標準ティアで最初からやり直す
+    tiers = [service_tier] if service_tier == "standard" else [service_tier, "standard"]
+    for tier in tiers:
+        config = {}
+        if cache_name:
+            config['cached_content'] = cache_name # 資料はキャッシュ側に含まれる
+        if tier != "standard":
+            config['service_tier'] = tier
+
+        # Generate content request (ストリームの消費まで含めてリトライの対象にする)
+        full = ""
+        last_chunk = None
+        try:
+            response_stream = client.models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=[{'role': 'user', 'parts': prompt_parts}],
+                config=config,
+            )
+            # Stream tokens to the page as they arrive
+            for chunk in response_stream:
+                last_chunk = chunk
+                if chunk.text:
+                    full += chunk.text
+                    placeholder.markdown(full)
+        except genai_errors.APIError as tier_error:
+            if tier == "standard" or tier_error.code not in TIER_FALLBACK_ERROR_CODES:
+                raise
+            placeholder.empty()
+            continue
+        break
+    placeholder.empty() # 最終結果は下の表示セクションで描画する
+
+    # Handle potential response errors or blocks
+    if not full:
+        # Attempt to access prompt_feedback for blocking reasons
+        feedback_reason = "不明な理由"
+        try:
+            if last_chunk.prompt_feedback and last_chunk.prompt_feedback.block_reason:
+                feedback_reason = last_chunk.prompt_feedback.block_reason_message or str(last_chunk.prompt_feedback.block_reason)
+        except Exception:
+            pass # Ignore if feedback structure is unexpected
+        raise GenerationError(f"AIが応答を生成できませんでした。理由: {feedback_reason}")
+    return full, tier
 
 # 2. THEME CONFIG
 # NOTE: This must be at the very top of the script execution
@@ -22,6 +334,16 @@ st.set_page_config(
 # 3. SESSION STATE INITIALIZATION
 if 'generated_content' not in st.session_state:
     st.session_state['generated_content'] = ""
+if 'context_caches' not in st.session_state:
+    st.session_state['context_caches'] = {} # ファイルハッシュ -> CachedContent名（キャッシュできない資料は None）
+if 'generated_results' not in st.session_state:
+    st.session_state['generated_results'] = {} # (ファイルハッシュ, 難易度, 形式, 焦点) -> 生成結果
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex[:8]
+if 'pending_batches' not in st.session_state:
+    st.session_state['pending_batches'] = [] # 実行中の Batch ジョブ名
+if 'batch_results' not in st.session_state:
+    st.session_state['batch_results'] = {} # Batch ジョブ名 -> [(ラベル, 生成結果)]
 
 # 4. APP SETUP
 st.title("💡 Study-Mixer - 資料形式を選ばないAI学習支援")
@@ -29,8 +351,7 @@ st.markdown("---")
 
 # 5. API KEY CONFIGURATION (公式推奨の方法)
 try:
-    API_KEY = st.secrets["GEMINI_API_KEY"]
-    genai.configure(api_key=API_KEY)
+    st.secrets["GEMINI_API_KEY"] # クライアントは Gemini を呼ぶ処理の中で初めて作る
 except KeyError: # More specific error handling
     st.error("エラー: .streamlit/secrets.toml に GEMINI_API_KEY が設定されていません。")
     st.stop()
@@ -41,16 +362,25 @@ except Exception as e:
 # 6. UI CONTROLS (Sidebar)
 with st.sidebar:
     st.header("⚙️ 問題生成オプション")
-    difficulty = st.selectbox("難易度を選択:", ("標準", "難しい (応用・論述)", "易しい (基本・用語)"))
-    format_type = st.selectbox("問題の形式を選択:", ("論述形式", "一問一答形式", "選択式（4択）"))
+    difficulty = st.selectbox("難易度を選択:", DIFFICULTY_OPTIONS)
+    format_type = st.selectbox("問題の形式を選択:", FORMAT_OPTIONS)
     professor_focus = st.text_area("先生が特に強調していた点を入力（任意）:", "（例：過去の社会問題との関連性を問う）", height=100)
+    service_tier = SERVICE_TIERS[st.radio("処理優先度", list(SERVICE_TIERS))]
     generate_button = st.button("問題を生成する")
 
+    st.markdown("---")
+    st.caption("全ての難易度×形式の組み合わせをまとめて生成します（Batch API: 料金50%・結果は非同期）。")
+    batch_button = st.button("全パターンを一括生成")
+    check_batch_button = st.button("結果を確認") # ジョブ送信と同じ実行内で押せるよう、常に有効にしておく
+
 # 7. FILE UPLOADER
 uploaded_file = st.file_uploader(
     "講義のシラバス、板書、資料（PDF/画像/音声）をアップロード",
-    type=["pdf", "png", "jpg", "jpeg", "mp3", "wav"] 
+    type=[extension[1:] for extension in FILE_HANDLERS] 
 )
+if uploaded_file is not None:
+    uploaded_path = Path(uploaded_file.name) # 拡張子・ファイル名はここで一度だけ取り出す
+    file_extension = uploaded_path.suffix.lower()
 
 # 8. AI PROCESSING LOGIC
 if uploaded_file is not None and generate_button:
@@ -58,105 +388,133 @@ if uploaded_file is not None and generate_button:
     st.session_state['processing_done'] = False # Reset flag on new generation
     st.session_state['generated_content'] = "" # Clear previous results
 
-    # Processing Status
-    with st.spinner("資料を解析し、AIが問題を生成中です..."):
-        
-        file_extension = Path(uploaded_file.name).suffix.lower() 
-        contents_for_model = [] 
-        gemini_uploaded_file = None 
-        temp_file_path = f"temp_file{file_extension}" # Use unique temp file name
+    # 同じ資料・同じオプションで生成済みなら、Gemini を呼ばずにその結果を使う
+    file_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    result_key = (file_hash, difficulty, format_type, professor_focus)
+    generated_results = st.session_state['generated_results']
 
-        try:
-            # 1. Save uploaded file temporarily
-            with open(temp_file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-
-            # 2. Upload file to Gemini (using genai.upload_file)
-            st.info(f"{file_extension.upper()} ファイルをアップロード中...")
-            gemini_uploaded_file = genai.upload_file(path=temp_file_path)
-            st.info("アップロード完了。AIによる解析を開始します...")
-
-            # 3. Prepare content list based on file type
-            if file_extension == ".pdf":
-                # PDF processing (using LangChain for text extraction only)
+    # Processing Status (進捗は1つのステータス要素のラベル更新で表示し、生成中の本文はステータスの外に流す)
+    try:
+        if result_key not in generated_results:
+            client = get_client()
+            status = st.status("資料を解析中…", expanded=False)
+            placeholder = st.empty()
+            with status: # 例外で抜けた場合は自動的にエラー表示になる
+                uploaded_material = None
+                material_parts = []
                 try:
-                    loader = PyPDFLoader(temp_file_path)
-                    documents = loader.load()
-                    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0) 
-                    texts = text_splitter.split_documents(documents)
-                    context_text = "\n\n".join([t.page_content for t in texts])
-                    contents_for_model.append(context_text)
-                    contents_for_model.append(gemini_uploaded_file) 
-                except Exception as pdf_error:
-                    st.error(f"PDF解析エラー: {pdf_error}")
-                    st.stop()
-
-            elif file_extension in [".jpg", ".jpeg", ".png"]:
-                contents_for_model.append("以下の画像は講義の板書または重要な図です。この画像の内容を完全に理解し、それに基づいた問題を生成してください。")
-                contents_for_model.append(gemini_uploaded_file)
-
-            elif file_extension in [".mp3", ".wav"]:
-                contents_for_model.append("以下の音声ファイルは講義の録音です。まず内容を完全に文字起こしし、その文字起こし内容だけを参照して問題を生成してください。")
-                contents_for_model.append(gemini_uploaded_file)
-                
-            else:
-                st.warning("サポートされていないファイル形式です。")
-                if os.path.exists(temp_file_path): os.remove(temp_file_path) # Clean up temp file
-                st.stop()
-
-        except Exception as e:
-            st.error(f"ファイル処理またはアップロードエラー: {e}")
-            if os.path.exists(temp_file_path): os.remove(temp_file_path)
-            st.stop()
+                    cache_name = load_cached_content(client, file_hash)
+                    if cache_name:
+                        status.update(label="キャッシュ済みの資料を再利用します（アップロードは省略）")
+                    else:
+                        status.update(label=f"{file_extension.upper()} ファイルを準備中…")
+                        material_parts, uploaded_material = prepare_material(client, file_bytes, file_extension, uploaded_file.name)
+                        cache_name = create_cached_content(client, file_hash, file_extension, material_parts)
+                        if cache_name:
+                            material_parts = [] # 資料はキャッシュ側に含まれる
 
-        # --- Final Prompt Construction and Execution ---
-        
-        final_prompt_text = f"""
-        あなたは**{Path(uploaded_file.name).stem}**の専門家です。
-        【生成ルール】: 難易度: {difficulty} / 形式: {format_type} / 焦点: {professor_focus}
-        このルールに従い、問題と模範解答を計5問作成してください。
-        """
-        contents_for_model.insert(0, final_prompt_text)
+                    status.update(label="AI生成中…")
+                    final_prompt_text = build_prompt_text(uploaded_path.stem, difficulty, format_type, professor_focus)
+                    generated_text, used_tier = stream_problems(client, [{'text': final_prompt_text}] + material_parts, cache_name, service_tier, placeholder)
+                finally:
+                    # --- Cleanup ---
+                    # キャッシュが参照しているファイルはキャッシュ有効中は削除しない（サーバー側で48時間後に自動削除）
+                    # 削除の完了は待たずにバックグラウンドで行い、結果の表示を先に進める
+                    if uploaded_material and not st.session_state['context_caches'].get(file_hash):
+                        threading.Thread(target=safe_delete_file, args=(client, uploaded_material.name), daemon=True).start()
+                generated_results[result_key] = generated_text
+                if used_tier != service_tier:
+                    # ステータスは折りたたまれているため、ティアの切り替えは完了ラベル自体に表示する
+                    status.update(label=f"完了（{service_tier} ティアが混雑していたため、標準ティアで生成しました）", state="complete")
+                else:
+                    status.update(label="完了", state="complete")
 
-        # Initialize the generative model
-        # Use a model known for multimodal capabilities if needed, e.g., gemini-1.5-flash
-        model = genai.GenerativeModel('models/gemini-2.5-flash') # Ensure multimodal model
+            if len(generated_results) > GENERATED_RESULTS_LIMIT:
+                generated_results.pop(next(iter(generated_results))) # 最も古い結果から捨てる
+        st.session_state['generated_content'] = generated_results[result_key]
+    except GenerationError as e:
+        st.error(str(e))
+        st.session_state['generated_content'] = f"エラー: {e}" # Store error message
+        st.stop()
+    except Exception as e:
+        st.error(f"AI生成エラーが発生しました: {e}")
+        st.session_state['generated_content'] = f"エラー: {e}" # Store error message
+        st.stop()
 
-        # Generate content request
+# 8-2. BATCH GENERATION (難易度×形式の全パターンを Batch API で一括生成)
+if uploaded_file is not None and batch_button:
+    with st.spinner("一括生成ジョブを送信中です..."):
+        client = get_client()
         try:
-            response = model.generate_content(contents_for_model)
-            # Handle potential response errors or blocks
-            if response.parts:
-                 st.session_state['generated_content'] = response.text
-            else:
-                 # Attempt to access prompt_feedback for blocking reasons
-                 feedback_reason = "不明な理由"
-                 try:
-                     if response.prompt_feedback and response.prompt_feedback.block_reason:
-                         feedback_reason = response.prompt_feedback.block_reason_message or str(response.prompt_feedback.block_reason)
-                 except Exception:
-                     pass # Ignore if feedback structure is unexpected
-                 st.error(f"AIが応答を生成できませんでした。理由: {feedback_reason}")
-                 st.session_state['generated_content'] = f"エラー: AI応答の取得に失敗しました ({feedback_reason})"
+            # 全パターンのリクエストに同じバイナリを埋め込まないよう、画像・音声は常にアップロードする
+            # Batch ジョブは非同期に実行されるため、ファイルはここでは削除しない（サーバー側で48時間後に自動削除）
+            material_parts, _ = prepare_material(client, uploaded_file.getvalue(), file_extension, uploaded_file.name, allow_inline=False)
+        except GenerationError as e:
+            st.error(str(e))
+            st.stop()
+
+        # 全ての組み合わせで同じ資料（アップロード済みファイル/抽出テキスト）を共有する
+        variant_labels = []
+        inline_requests = []
+        for variant_difficulty, variant_format in itertools.product(DIFFICULTY_OPTIONS, FORMAT_OPTIONS):
+            prompt_text = build_prompt_text(uploaded_path.stem, variant_difficulty, variant_format, professor_focus)
+            variant_labels.append(f"{variant_difficulty} × {variant_format}")
+            inline_requests.append({
+                'contents': [{'parts': [{'text': prompt_text}] + material_parts, 'role': 'user'}],
+            })
 
+        try:
+            batch_job = client.batches.create(
+                model=MODEL_NAME,
+                src=inline_requests,
+                config={'display_name': f"studymixer-{st.session_state['session_id']}"},
+            )
         except Exception as e:
-            st.error(f"AI生成エラーが発生しました: {e}")
-            st.session_state['generated_content'] = f"エラー: {e}" # Store error message
+            st.error(f"一括生成ジョブの送信エラー: {e}")
             st.stop()
 
-        finally: 
-             # --- Cleanup ---
-            if gemini_uploaded_file:
-                try:
-                    genai.delete_file(gemini_uploaded_file.name) 
-                except Exception as cleanup_error:
-                    st.warning(f"Geminiファイル削除中にエラー: {cleanup_error}") 
-            
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path) 
-            
+        st.session_state['batch_labels'] = {**st.session_state.get('batch_labels', {}), batch_job.name: variant_labels}
+        st.session_state['pending_batches'].append(batch_job.name)
+        st.success(f"一括生成ジョブを送信しました（{len(inline_requests)}パターン）。「結果を確認」ボタンで進捗を確認できます。")
+
+if check_batch_button and not st.session_state['pending_batches']:
+    st.info("確認待ちの一括生成ジョブはありません。")
+elif check_batch_button:
+    client = get_client()
+    for batch_name in list(st.session_state['pending_batches']):
+        try:
+            batch_job = client.batches.get(name=batch_name)
+        except Exception as e:
+            st.error(f"一括生成ジョブの確認エラー: {e}")
+            continue
+
+        state = batch_job.state.name
+        if state == 'JOB_STATE_SUCCEEDED':
+            labels = st.session_state.get('batch_labels', {}).get(batch_name, [])
+            results = []
+            for i, inline_response in enumerate(batch_job.dest.inlined_responses):
+                label = labels[i] if i < len(labels) else f"パターン{i + 1}"
+                if inline_response.response:
+                    results.append((label, inline_response.response.text))
+                else:
+                    results.append((label, f"エラー: {inline_response.error}"))
+            st.session_state['batch_results'][batch_name] = results
+            st.session_state['pending_batches'].remove(batch_name)
+        elif state in ('JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED'):
+            st.error(f"一括生成ジョブが完了しませんでした（{state}）: {batch_job.error}")
+            st.session_state['pending_batches'].remove(batch_name)
+        else:
+            st.info(f"一括生成ジョブを処理中です（{state}）。しばらくしてから再度確認してください。")
 
 # 9. DISPLAY AI GENERATED RESULT
 if st.session_state['generated_content']:
     st.header("--- AI生成結果 ---")
     st.markdown(st.session_state['generated_content'])
+
+if st.session_state['batch_results']:
+    st.header("--- AI生成結果（一括生成） ---")
+for results in st.session_state['batch_results'].values():
+    for label, text in results:
+        with st.expander(label):
+            st.markdown(text)